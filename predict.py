@@ -120,16 +120,49 @@ def predict(image_path, model, cuda, topk):
     # Return results
     return probs.numpy()[0], mapped_classes
 
+def build_classifier(arch):
+    # Mirrors the classifier layout train.py attaches for each architecture.
+    if arch == 'densenet121':
+        dims = (1024, 550, 200)
+    else:
+        dims = (25088, 5000, 500)
+    return nn.Sequential(OrderedDict([
+                            ('input',  nn.Linear(dims[0], dims[1])),
+                            ('relu1',  nn.ReLU()),
+                            ('dropout1',  nn.Dropout(0.5)),
+                            ('linear2',  nn.Linear(dims[1], dims[2])),
+                            ('relu2',  nn.ReLU()),
+                            ('linear3', nn.Linear(dims[2], 102)),
+                            ('output', nn.LogSoftmax(dim=1))
+                           ]))
+
+
 def load_checkpoint(filepath, cuda):
-    checkpoint = torch.load(filepath)
-    model = checkpoint['model']
-    model.classifier = checkpoint['classifier']
-    model.load_state_dict(checkpoint['state_dict'])
+    # Checkpoints only carry the trained head and metadata; the pretrained
+    # backbone is rebuilt from torchvision instead of being unpickled.
+    checkpoint = torch.load(filepath, map_location='cuda' if cuda else 'cpu')
+
+    if checkpoint['arch'] == 'densenet121':
+        model = models.densenet121(pretrained=True)
+    else:
+        model = models.vgg19(pretrained=True)
+
+    model.classifier = build_classifier(checkpoint['arch'])
+    model.classifier.load_state_dict(checkpoint['classifier_state_dict'])
+    if 'backbone_state_dict' in checkpoint:
+        # Fine-tuned run: backbone weights differ from the pretrained ones.
+        model.features.load_state_dict(checkpoint['backbone_state_dict'])
     model.class_to_idx = checkpoint['class_to_idx']
-    optimizer = checkpoint['optimizer']
-    epochs = checkpoint['epochs']
-    
+
+    # The rebuilt model lives on CPU; move it over before predict() feeds
+    # it CUDA tensors.
+    if cuda:
+        model = model.cuda()
+
     for param in model.parameters():
-        param.requires_grad = False    
+        param.requires_grad = False
     return model
-main()
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
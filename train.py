@@ -6,6 +6,7 @@
 #Use GPU for training: python train.py data_dir --gpu
 
 import argparse
+import contextlib
 import os
 import numpy as np
 import pandas
@@ -17,26 +18,65 @@ import json
 
 from torch import nn
 from torch import optim
-from torch.autograd import Variable
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torchvision import datasets, transforms, models
+from kornia import augmentation
 from collections import OrderedDict
 from PIL import Image
 
 
 def main():
     args = get_arguments()
+    # One worker process per GPU; a single process otherwise. Each rank
+    # trains on its own shard of the data with DDP syncing gradients.
+    world_size = torch.cuda.device_count() if args.cuda else 1
+    if args.checkpointing and world_size > 1:
+        # Gradient checkpointing recomputes the backbone forward inside
+        # backward, which does not compose with the head-only DDP setup.
+        raise SystemExit('--checkpoint fine-tuning only supports a single GPU; restrict with CUDA_VISIBLE_DEVICES')
+    if world_size > 1:
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        # DDP ranks own a CUDA context, so their DataLoader workers must not
+        # fork; spawn is safe on every platform.
+        torch.multiprocessing.set_start_method('spawn', force=True)
+        torch.multiprocessing.spawn(worker, args=(world_size, args), nprocs=world_size)
+    else:
+        worker(0, 1, args)
+
+
+def worker(rank, world_size, args):
+    # Shapes are fixed (224x224, constant batch), so let cuDNN benchmark
+    # conv algorithms once and reuse the fastest, and allow TF32 tensor
+    # cores for FP32 matmuls/convs on Ampere+.
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    distributed = world_size > 1
+    if distributed:
+        torch.cuda.set_device(rank)
+        dist.init_process_group('nccl', rank=rank, world_size=world_size)
+
     input_layers = None
     output_size = None
-    if not os.path.exists(args.save_dir):
-        os.makedirs(args.save_dir)
+    # exist_ok: every spawned rank runs this concurrently, so a plain
+    # exists-check/makedirs pair races between ranks.
+    os.makedirs(args.save_dir, exist_ok=True)
     save_dir = os.path.join(args.save_dir, 'checkpoint.pth')
-    
+
+    # Let rank 0 download the pretrained weights into the torch hub cache
+    # alone; every other rank waits and then gets a warm cache hit instead
+    # of all ranks racing the same download.
+    if distributed and rank != 0:
+        dist.barrier()
+
     if args.model == 'densenet121':
         input_layers = 1024
         output_size = 102
         model = models.densenet121(pretrained=True)
-        for param in model.parameters():
-            param.requires_grad = False
         classifier = nn.Sequential(OrderedDict([
                                         ('input',  nn.Linear(1024, 550)),
                                         ('relu1',  nn.ReLU()),
@@ -51,8 +91,6 @@ def main():
         input_layers = 25088
         output_size = 102
         model = models.vgg19(pretrained=True)
-        for param in model.parameters():
-            param.requires_grad = False
         classifier = nn.Sequential(OrderedDict([
                                         ('input',  nn.Linear(25088, 5000)),
                                         ('relu1',  nn.ReLU()),
@@ -63,163 +101,357 @@ def main():
                                         ('output', nn.LogSoftmax(dim=1))
                                        ])) 
     
+    # Weights are cached now; release the non-zero ranks.
+    if distributed and rank == 0:
+        dist.barrier()
+
+    # --checkpoint fine-tunes the backbone end-to-end, trading recompute for
+    # activation memory via checkpoint_sequential; otherwise it stays frozen.
+    if not args.checkpointing:
+        for param in model.parameters():
+            param.requires_grad = False
+
     model.classifier = classifier
-    data_loaders, image_datasets, data_transforms = data_parser(args.data_path)
-    
+
+    # AMP + the no_grad backbone freed enough memory that batch 64 leaves the
+    # GPU underutilized; default higher per arch (vgg19's classifier is much
+    # bigger). The learning rate is rescaled by sqrt(batch/64) - the usual
+    # Adam scaling - so defaults stay comparable to the old batch-64 runs.
+    batch_size = args.batch_size
+    if batch_size is None:
+        batch_size = 256 if args.model == 'vgg19' else 512
+    lr = args.lr * (batch_size / 64) ** 0.5
+
+    data_loaders, image_datasets, data_transforms = data_parser(args.data_path, distributed=distributed, batch_size=batch_size)
+
     if args.cuda:
         model = model.cuda()
-    
+        # NHWC weights let cuDNN dispatch tensor-core conv kernels directly
+        # instead of transposing layouts inside every conv.
+        model = model.to(memory_format=torch.channels_last)
+
+    # Only the head has gradients (the backbone runs under no_grad), so DDP
+    # wraps just the classifier; wrapping the full model would never see a
+    # forward() call since train_model drives features/classifier directly.
+    if distributed:
+        model.classifier = DistributedDataParallel(model.classifier, device_ids=[rank])
+
+    # Fuse the Linear/ReLU/Dropout stack and cut per-op dispatch overhead.
+    # torch.compile exists from 2.0 on; fall back to TorchScript before that.
+    if hasattr(torch, 'compile'):
+        model.classifier = torch.compile(model.classifier, mode="max-autotune")
+    elif not distributed:
+        model.classifier = torch.jit.script(model.classifier)
+
     criterion = nn.NLLLoss()
-    optimizer = optim.Adam(model.classifier.parameters(), lr=args.lr)
-    
-    train_model(model, data_loaders, criterion=criterion, optimizer=optimizer, epochs=int(args.epochs), cuda=args.cuda)
-    
+    trainable_params = list(model.parameters() if args.checkpointing else model.classifier.parameters())
+    # Fused Adam runs the moment updates as one CUDA kernel instead of 4-5
+    # launches per parameter tensor (the vgg19 head alone has 12 tensors).
+    try:
+        optimizer = optim.Adam(trainable_params, lr=lr, fused=args.cuda)
+    except TypeError:
+        # torch < 1.13 has no fused flag
+        optimizer = optim.Adam(trainable_params, lr=lr)
+
+    augment = gpu_augmentations()
+    if args.cuda:
+        augment = augment.cuda()
+
+    train_model(model, data_loaders, criterion=criterion, optimizer=optimizer, augment=augment, epochs=args.epochs, cuda=args.cuda, rank=rank, accum_steps=args.accum_steps, checkpointing=args.checkpointing)
+
     #validate_model(model, data_loaders[2], cuda=args.cuda)
 
-    checkpoint = {'input_size': input_layers,
+    if rank != 0:
+        if distributed:
+            dist.destroy_process_group()
+        return
+
+    # Only the trained head plus metadata gets saved; the pretrained backbone
+    # is reconstructed from torchvision on load. 'classifier' is the raw
+    # module whose parameters are shared with the DDP/compile wrappers, so
+    # its state_dict has clean key names.
+    checkpoint = {'arch': args.model,
+                  'input_size': input_layers,
                   'output_size': output_size,
                   'epochs': args.epochs,
-                  'learning_rate':args.lr,
-                  'batch_size': 64,
-                  'data_transforms': data_transforms,
-                  'model': model,
-                  'classifier': classifier,
-                  'optimizer': optimizer.state_dict(),
-                  'state_dict': model.state_dict(),
+                  'learning_rate':lr,
+                  'hidden_units': args.hidden_units,
+                  'batch_size': batch_size,
+                  'classifier_state_dict': classifier.state_dict(),
                   'class_to_idx': image_datasets[0].class_to_idx
                 }
+    if args.checkpointing:
+        # Fine-tuned backbone weights differ from the pretrained ones.
+        checkpoint['backbone_state_dict'] = model.features.state_dict()
+
+    torch.save(checkpoint, save_dir)
+
+    if distributed:
+        dist.destroy_process_group()
 
-    torch.save(checkpoint, 'checkpoint.pth')
-    
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     
     parser.add_argument("--save_dir", action="store", dest="save_dir", default="." , help = "Set directory to save checkpoints")
     parser.add_argument("--model", action="store", dest="model", default="densenet121" , help = "Set architechture('densenet121' or     'vgg19')")
-    parser.add_argument("--learning_rate", action="store", dest="lr", default=0.001 , help = "Set learning rate")
-    parser.add_argument("--hidden_units", action="store", dest="hidden_units", default=512 , help = "Set number of hidden units")
-    parser.add_argument("--epochs", action="store", dest="epochs", default=5 , help = "Set number of epochs")
+    parser.add_argument("--learning_rate", action="store", dest="lr", type=float, default=0.001 , help = "Set learning rate")
+    parser.add_argument("--hidden_units", action="store", dest="hidden_units", type=int, default=512 , help = "Set number of hidden units")
+    parser.add_argument("--epochs", action="store", dest="epochs", type=int, default=5 , help = "Set number of epochs")
+    parser.add_argument("--batch_size", action="store", dest="batch_size", type=int, default=None , help = "Batch size per process (default 512 for densenet121, 256 for vgg19; learning rate is rescaled by sqrt(batch/64))")
     parser.add_argument("--gpu", action="store_true", dest="cuda", default=False , help = "Use CUDA for training")
+    parser.add_argument("--accum_steps", action="store", dest="accum_steps", type=int, default=1 , help = "Accumulate gradients over this many batches before stepping")
+    parser.add_argument("--checkpoint", action="store_true", dest="checkpointing", default=False , help = "Fine-tune the backbone with gradient checkpointing instead of freezing it")
     parser.add_argument('data_path', action="store")
     
     return parser.parse_args()
 
-def data_parser(data_path):    
+def data_parser(data_path, distributed=False, batch_size=64):
     train_dir = data_path + '/train'
     valid_dir = data_path + '/valid'
     test_dir = data_path + '/test'
-    
-    batch_size = 64
-    
+
+    num_workers = min(8, os.cpu_count())
+
     data_transforms = [transforms.Compose([transforms.Resize(256), 
                                          transforms.CenterCrop(224),
                                          transforms.ToTensor(),
                                          transforms.Normalize([0.485, 0.456, 0.406], 
                                                               [0.229, 0.224, 0.225])]),
 
-                     transforms.Compose([transforms.RandomRotation(30),
-                                           transforms.RandomResizedCrop(224),
-                                           transforms.RandomHorizontalFlip(),
-                                           transforms.ToTensor(),
-                                           transforms.Normalize([0.485, 0.456, 0.406],
-                                                                [0.229, 0.224, 0.225])])]
+                     # Training images only get decoded to uint8 here; the random
+                     # augmentations and normalize run batched on the GPU instead.
+                     transforms.Compose([transforms.Resize(256),
+                                           transforms.CenterCrop(224),
+                                           transforms.PILToTensor()])]
 
     image_datasets = [datasets.ImageFolder(train_dir, transform=data_transforms[1]),   # image dataset for training
                       datasets.ImageFolder(valid_dir, transform=data_transforms[0]),   # image dataset for validation
                       datasets.ImageFolder(test_dir,  transform=data_transforms[0])]   # image dataset for testing
 
-    dataloaders = [torch.utils.data.DataLoader(image_datasets[0], batch_size=batch_size, shuffle=True), # data loader for training
-                   torch.utils.data.DataLoader(image_datasets[1], batch_size=batch_size),             # data loader for validation
-                   torch.utils.data.DataLoader(image_datasets[2], batch_size=batch_size)]               # data loader for testing
+    # Under DDP each rank sees its own shard of the training set; the sampler
+    # replaces shuffle=True and is re-seeded per epoch via set_epoch.
+    train_sampler = torch.utils.data.distributed.DistributedSampler(image_datasets[0], shuffle=True) if distributed else None
+
+    # pin_memory allocates batches in page-locked RAM so .cuda(non_blocking=True) can DMA async.
+    # Worker processes decode/augment in parallel and stay alive between epochs.
+    dataloaders = [torch.utils.data.DataLoader(image_datasets[0], batch_size=batch_size, shuffle=train_sampler is None,
+                                               sampler=train_sampler, pin_memory=True,
+                                               num_workers=num_workers, prefetch_factor=4, persistent_workers=True), # data loader for training
+                   torch.utils.data.DataLoader(image_datasets[1], batch_size=batch_size, pin_memory=True,
+                                               num_workers=num_workers, prefetch_factor=4, persistent_workers=True), # data loader for validation
+                   torch.utils.data.DataLoader(image_datasets[2], batch_size=batch_size, pin_memory=True,
+                                               num_workers=num_workers, prefetch_factor=4, persistent_workers=True)] # data loader for testing
     
     return dataloaders, image_datasets, data_transforms
 
-def train_model(model, dataloaders, criterion, optimizer, epochs=10, cuda=False):
+def extract_features(model, inputs, checkpointing=False):
+    # Replicates the torchvision forward between .features and .classifier
+    # (densenet pools with relu+adaptive_avg_pool, vgg has its own avgpool).
+    if checkpointing:
+        # Recompute backbone activations during backward instead of
+        # stashing them; only worthwhile when the backbone is trainable.
+        features = torch.utils.checkpoint.checkpoint_sequential(model.features, 4, inputs, use_reentrant=False)
+    else:
+        features = model.features(inputs)
+    if isinstance(model, models.DenseNet):
+        features = F.relu(features, inplace=True)
+        features = F.adaptive_avg_pool2d(features, (1, 1))
+    else:
+        features = model.avgpool(features)
+    return torch.flatten(features, 1)
+
+
+def cache_features(model, dataloader, cuda=False):
+    # The valid/test transforms are deterministic and the backbone is frozen,
+    # so its features for those sets never change. Compute them once and
+    # train/evaluate the classifier head against the cached tensors.
+    model.eval()
+    feature_batches = []
+    label_batches = []
+    with torch.no_grad():
+        for images, labels in dataloader:
+            if cuda:
+                images = images.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+            with torch.cuda.amp.autocast(enabled=cuda):
+                features = extract_features(model, images)
+            feature_batches.append(features.float().cpu())
+            label_batches.append(labels)
+    model.train()
+
+    cached = torch.utils.data.TensorDataset(torch.cat(feature_batches),
+                                            torch.cat(label_batches))
+    return torch.utils.data.DataLoader(cached, batch_size=512, pin_memory=True)
+
+
+def gpu_augmentations():
+    # Batched replacement for the old per-image CPU transforms: one fused
+    # kernel per op over the whole batch instead of three kernels per image.
+    return augmentation.AugmentationSequential(
+        augmentation.RandomRotation(30.),
+        augmentation.RandomResizedCrop((224, 224)),
+        augmentation.RandomHorizontalFlip(),
+        augmentation.Normalize(mean=torch.tensor([0.485, 0.456, 0.406]),
+                               std=torch.tensor([0.229, 0.224, 0.225])))
+
+
+def train_model(model, dataloaders, criterion, optimizer, augment, epochs=10, cuda=False, rank=0, accum_steps=1, checkpointing=False):
     start_time = time.time()
     steps = 0
     print_every = 10
-    
+
     # Checking if gpu available
     if cuda:
         model.cuda()
     else:
         model.cpu()
 
+    # Scaler keeps FP16 gradients from underflowing, does nothing on CPU.
+    scaler = torch.cuda.amp.GradScaler(enabled=cuda)
+
+    # One-off backbone pass over the validation set (see cache_features).
+    # Rank 0 is the only rank that validates and prints. When fine-tuning
+    # the backbone its features move every step, so caching would go stale
+    # and validation falls back to full forwards over dataloaders[1].
+    valid_loader = None
+    val_len = 0
+    if rank == 0 and not checkpointing:
+        valid_loader = cache_features(model, dataloaders[1], cuda=cuda)
+    elif rank == 0:
+        valid_loader = dataloaders[1]
+    if valid_loader is not None:
+        # len() walks the sampler; do it once, not twice per print.
+        val_len = len(valid_loader)
+
+    train_loader = dataloaders[0]
+    train_sampler = train_loader.sampler
+
+    # Only the classifier runs during cached-feature validation, so toggle
+    # train/eval on the head alone instead of walking densenet's whole
+    # module tree (plenty of BN layers) every print_every steps.
+    eval_module = model if checkpointing else model.classifier
+
+    # The DDP wrapper (if any) sits underneath the torch.compile wrapper;
+    # no_sync() has to be called on the DDP module itself.
+    ddp_head = getattr(model.classifier, '_orig_mod', model.classifier)
+    distributed = isinstance(ddp_head, DistributedDataParallel)
+
     # Epochs loop.
     for e in range(epochs):
+        if isinstance(train_sampler, torch.utils.data.distributed.DistributedSampler):
+            train_sampler.set_epoch(e)
         running_loss = 0
-        for ii, (inputs, labels) in enumerate(dataloaders[0]):
-            inputs, labels = Variable(inputs), Variable(labels)
+        for ii, (inputs, labels) in enumerate(train_loader):
             steps += 1
-            
+
             if cuda:
-                inputs, labels = inputs.cuda(), labels.cuda()
-            
-            optimizer.zero_grad()
-            outputs = model.forward(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            
-            running_loss += loss.data[0]
-            
-            if steps % print_every == 0:
-                model.eval()
-            
-                accuracy = 0
-                validation_loss = 0
+                # uint8 batches halve the bytes moved host->device
+                inputs, labels = inputs.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+
+            inputs = augment(inputs.float().div_(255))
+            if cuda:
+                # Match the model's channels_last layout before the convs.
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
+
+            # Only the last micro-batch of an accumulation window triggers the
+            # DDP allreduce; the rest just add into local .grad buffers.
+            boundary = (ii + 1) % accum_steps == 0
+            sync_context = contextlib.nullcontext() if boundary or not distributed else ddp_head.no_sync()
+
+            with sync_context:
+                # Run forward + loss in mixed precision on tensor cores.
+                with torch.cuda.amp.autocast(enabled=cuda):
+                    if checkpointing:
+                        features = extract_features(model, inputs, checkpointing=True)
+                    else:
+                        # Backbone is frozen, so skip autograd bookkeeping for it
+                        # and only build a graph over the classifier head.
+                        with torch.no_grad():
+                            features = extract_features(model, inputs)
+                    outputs = model.classifier(features)
+                    loss = criterion(outputs, labels)
+                # Scale down so accumulated gradients match a single big batch.
+                scaler.scale(loss / accum_steps).backward()
+
+            if boundary:
+                scaler.step(optimizer)
+                scaler.update()
+                # Free .grad instead of writing ~500MB of zeros (vgg19 head)
+                optimizer.zero_grad(set_to_none=True)
+
+            # Keep the running loss as a detached device tensor; .item() at
+            # print time is the only sync.
+            running_loss += loss.detach()
             
-                for ii, (images, labels) in enumerate(dataloaders[1]):
-                    #Avoiding gradients
-                    with torch.no_grad():
-                        inputs = Variable(images)
-                        labels = Variable(labels)
-        
+            if steps % print_every == 0 and rank == 0:
+                eval_module.eval()
+
+                # Accumulate on-device; a host-side float per batch would
+                # force a GPU->CPU sync every iteration.
+                device = 'cuda' if cuda else 'cpu'
+                correct = torch.zeros((), device=device)
+                validation_loss = torch.zeros((), device=device)
+                sample_count = 0
+
+                for ii, (features, labels) in enumerate(valid_loader):
                     if cuda:
-                        inputs, labels = inputs.cuda(), labels.cuda()
-        
-                    output = model.forward(inputs)
-                    validation_loss += criterion(output, labels).data[0]
-                    ps = torch.exp(output).data
-                    equality = (labels.data == ps.max(1)[1])
-                    accuracy += equality.type_as(torch.FloatTensor()).mean()
+                        features, labels = features.cuda(non_blocking=True), labels.cuda(non_blocking=True)
 
+                    #Avoiding gradients, autocast only (no scaler needed without backward)
+                    with torch.no_grad(), torch.cuda.amp.autocast(enabled=cuda):
+                        if checkpointing:
+                            # valid_loader yields raw images in this mode
+                            features = extract_features(model, features)
+                        output = model.classifier(features)
+                        validation_loss += criterion(output, labels).detach()
+                    # argmax of log-probabilities, no exp needed for top-1
+                    correct += (output.argmax(1) == labels).sum()
+                    sample_count += labels.size(0)
+
+                # Single device->host sync for the whole validation pass.
                 print("[Stats] -> ",
                       "Epoch: {} / {}.. ".format(e+1, epochs),
-                      "Training Loss: {:.3f}.. ".format(running_loss/print_every),
-                      "Validation Loss: {:.3f}.. ".format(validation_loss/len(dataloaders[1])),
-                      "Validation Accuracy: {:.3f}".format(accuracy/len(dataloaders[1])))
+                      "Training Loss: {:.3f}.. ".format((running_loss/print_every).item()),
+                      "Validation Loss: {:.3f}.. ".format((validation_loss/val_len).item()),
+                      "Validation Accuracy: {:.3f}".format((correct/sample_count).item()))
 
                 running_loss = 0
-                model.train()
+                eval_module.train()
                 
     elapsed_time = time.time() - start_time
-    print('Elapsed Time: {:.0f}m {:.0f}s'.format(elapsed_time//60, elapsed_time % 60))
+    if rank == 0:
+        print('Elapsed Time: {:.0f}m {:.0f}s'.format(elapsed_time//60, elapsed_time % 60))
  
   
-def validate_model(model, dataloaders, cuda=False):
-    model.eval()
-    accuracy = 0
+def validate_model(model, dataloader, cuda=False):
     # Validate if GPU available
     if cuda:
         model.cuda()
     else:
         model.cpu()
 
-    for ii, (images, labels) in enumerate(dataloaders[2]):
+    # Backbone features for the test set are computed once up front too.
+    test_loader = cache_features(model, dataloader, cuda=cuda)
+    model.eval()
 
-        with torch.no_grad():
-            inputs = Variable(images)
-            labels = Variable(labels)
+    # On-device accumulators, read back once at the end.
+    device = 'cuda' if cuda else 'cpu'
+    correct = torch.zeros((), device=device)
+    sample_count = 0
 
+    for ii, (features, labels) in enumerate(test_loader):
         if cuda:
-            inputs, labels = inputs.cuda(), labels.cuda()
+            features, labels = features.cuda(non_blocking=True), labels.cuda(non_blocking=True)
+
+        with torch.no_grad():
+            output = model.classifier(features)
+        correct += (output.argmax(1) == labels).sum()
+        sample_count += labels.size(0)
+
+    print("Testing Accuracy: {:.3f}".format((correct/sample_count).item()))
 
-        output = model.forward(inputs)
-        ps = torch.exp(output).data
-        equality = (labels.data == ps.max(1)[1])
-        accuracy += equality.type_as(torch.FloatTensor()).mean()
 
-    print("Testing Accuracy: {:.3f}".format(accuracy/len(dataloaders[2])))
-main()
\ No newline at end of file
+# Guarded so DataLoader workers and spawned DDP ranks can re-import this
+# module without recursively kicking off training.
+if __name__ == "__main__":
+    main()
\ No newline at end of file